@@ -11,6 +11,11 @@ import sys
 import argparse
 import stat
 import enum
+import re
+import tempfile
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 class ObjectType(enum.Enum):
@@ -19,6 +24,20 @@ class ObjectType(enum.Enum):
     blob = 3
 
 
+_sha1 = hashlib.sha1
+_HASH_CHUNK_SIZE = 1 << 20
+_COMPRESS_CHUNK_SIZE = 256 << 10
+_ENTRY = struct.Struct('!LLLLLLLLLL20sH')
+_HDR = struct.Struct('!4sLL')
+_ENTRY_STAT = struct.Struct('!L4xL24xL')
+_ENTRY_FLAGS = struct.Struct('!60xH')
+_COMMIT_LINK = re.compile(rb'^(tree|parent) ([0-9a-f]{40})$', re.M)
+_known_sha1s = {}
+_OBJECT_CACHE_SIZE = 8192
+_object_cache = collections.OrderedDict()
+_object_cache_lock = threading.Lock()
+
+
 IndexEntry = collections.namedtuple('IndexEntry', [
     'ctime_s', 'ctime_n', 'mtime_s', 'mtime_n', 'dev', 'ino', 'mode', 'uid',
     'gid', 'size', 'sha1', 'flags', 'path',
@@ -54,16 +73,51 @@ def init(repo):
     print(f"""initialized empty repository: {repo}""")
 
 
+def known_sha1s(prefix):
+
+    obj_dir = os.path.abspath(os.path.join('.git', 'objects', prefix))
+    known = _known_sha1s.get(obj_dir)
+    if known is None:
+        try:
+            with os.scandir(obj_dir) as it:
+                known = {prefix + e.name for e in it}
+        except FileNotFoundError:
+            known = set()
+        _known_sha1s[obj_dir] = known
+
+    return known
+
+
 def hash_object(data, obj_type, write=True):
 
-    header = f"""{obj_type} {len(data)}""".encode()
-    full_data = header + b'\x00' + data
-    sha1 = hashlib.sha1(full_data).hexdigest()
+    header = f"""{obj_type} {len(data)}""".encode() + b'\x00'
+    view = memoryview(data)
+    h = _sha1(header)
+    for i in range(0, len(view), _HASH_CHUNK_SIZE):
+        h.update(view[i:i + _HASH_CHUNK_SIZE])
+    sha1 = h.hexdigest()
     if write:
-        path = os.path.join('.git', 'objects', sha1[:2], sha1[2:])
-        if not os.path.exists(path):
+        known = known_sha1s(sha1[:2])
+        if sha1 not in known:
+            path = os.path.join('.git', 'objects', sha1[:2], sha1[2:])
             os.makedirs(os.path.dirname(path), exist_ok=True)
-            write_file(path, zlib.compress(full_data))
+            fd, tmp_path = tempfile.mkstemp(
+                prefix='tmp_obj_', dir=os.path.join('.git', 'objects'))
+            try:
+                compressor = zlib.compressobj(6)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(compressor.compress(header))
+                    for i in range(0, len(view), _COMPRESS_CHUNK_SIZE):
+                        f.write(compressor.compress(
+                            view[i:i + _COMPRESS_CHUNK_SIZE]))
+                    f.write(compressor.flush())
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp_path)
+                raise
+            known.add(sha1)
 
     return sha1
 
@@ -75,7 +129,17 @@ def find_object(sha1_prefix):
 
     obj_dir = os.path.join('.git', 'objects', sha1_prefix[:2])
     rest = sha1_prefix[2:]
-    objects = [name for name in os.listdir(obj_dir) if name.startswith(rest)]
+    if len(sha1_prefix) == 40:
+        path = os.path.join(obj_dir, rest)
+        if not os.path.exists(path):
+            raise ValueError(f"""object {sha1_prefix} not found""")
+        return path
+
+    try:
+        with os.scandir(obj_dir) as it:
+            objects = [e.name for e in it if e.name.startswith(rest)]
+    except FileNotFoundError:
+        objects = []
 
     if not objects:
         raise ValueError(f"""object {sha1_prefix} not found""")
@@ -102,6 +166,23 @@ def read_object(sha1_prefix):
     return (obj_type, data)
 
 
+def read_object_cached(sha1, store=True):
+
+    with _object_cache_lock:
+        obj = _object_cache.get(sha1)
+        if obj is not None:
+            _object_cache.move_to_end(sha1)
+            return obj
+    obj = read_object(sha1)
+    if store:
+        with _object_cache_lock:
+            _object_cache[sha1] = obj
+            if len(_object_cache) > _OBJECT_CACHE_SIZE:
+                _object_cache.popitem(last=False)
+
+    return obj
+
+
 def cat_file(mode, sha1_prefix):
 
     obj_type, data = read_object(sha1_prefix)
@@ -127,40 +208,72 @@ def cat_file(mode, sha1_prefix):
         raise ValueError('unexpected mode {!r}'.format(mode))
 
 
-def read_index():
+def read_index_data():
 
     try:
         data = read_file(os.path.join('.git', 'index'))
     except FileNotFoundError:
-        return []
+        return 0, b''
 
-    digest = hashlib.sha1(data[:-20]).digest()
+    digest = _sha1(data[:-20]).digest()
 
     assert digest == data[-20:], f"""invalid index checksum"""
 
-    signature, version, num_entries = struct.unpack('!4sLL', data[:12])
+    signature, version, num_entries = _HDR.unpack_from(data)
 
     assert signature == b'DIRC', f"""invalid index signature {signature}"""
     assert version == 2, f"""unknown index version {version}"""
 
-    entry_data = data[12:-20]
-    entries = []
+    return num_entries, data[12:-20]
+
+
+def index_offsets(entry_data):
+
+    offsets = []
     i = 0
     while i + 62 < len(entry_data):
-        fields_end = i + 62
-        fields = struct.unpack('!LLLLLLLLLL20sH', entry_data[i:fields_end])
-        path_end = entry_data.index(b'\x00', fields_end)
-        path = entry_data[fields_end:path_end]
-        entry = IndexEntry(*(fields + (path.decode(),)))
-        entries.append(entry)
-        entry_len = ((62 + len(path) + 8) // 8) * 8
-        i += entry_len
+        path_len = _ENTRY_FLAGS.unpack_from(entry_data, i)[0] & 0xfff
+        if path_len < 0xfff:
+            path_end = i + 62 + path_len
+        else:
+            path_end = entry_data.index(b'\x00', i + 62)
+        offsets.append((i, path_end))
+        i += (path_end - i + 8) & ~7
+
+    return offsets
+
+
+def read_index():
+
+    num_entries, entry_data = read_index_data()
+    offsets = index_offsets(entry_data)
+    entries = []
+    for i, path_end in offsets:
+        fields = _ENTRY.unpack_from(entry_data, i)
+        path = entry_data[i + 62:path_end]
+        entries.append(IndexEntry(*(fields + (path.decode(),))))
 
     assert len(entries) == num_entries
 
     return entries
 
 
+def read_index_stats():
+
+    num_entries, entry_data = read_index_data()
+    offsets = index_offsets(entry_data)
+    stats = {}
+    for i, path_end in offsets:
+        ctime_s, mtime_s, size = _ENTRY_STAT.unpack_from(entry_data, i)
+        path = entry_data[i + 62:path_end].decode()
+        stats[path] = (ctime_s, mtime_s, size,
+                       entry_data[i + 40:i + 60].hex())
+
+    assert len(stats) == num_entries
+
+    return stats
+
+
 def ls_files(details=False):
 
     for entry in read_index():
@@ -172,24 +285,55 @@ def ls_files(details=False):
             print(entry.path)
 
 
+def hash_blob(path):
+
+    return path, hash_object(read_file(path), 'blob', write=False)
+
+
 def get_status():
 
-    paths = set()
-    for root, dirs, files in os.walk('.'):
-        dirs[:] = [d for d in dirs if d != '.git']
-        for file in files:
-            path = os.path.join(root, file)
-            path = path.replace('\\', '/')
-            if path.startswith('./'):
-                path = path[2:]
-            paths.add(path)
-    entries_by_path = {e.path: e for e in read_index()}
-    entry_paths = set(entries_by_path)
-    changed = {p for p in (paths & entry_paths)
-               if hash_object(read_file(p), 'blob', write=False) !=
-               entries_by_path[p].sha1.hex()}
-    new = paths - entry_paths
-    deleted = entry_paths - paths
+    dir_entries = {}
+    stack = ['.']
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for dir_entry in it:
+                if dir_entry.is_dir():
+                    if dir_entry.name != '.git' and not dir_entry.is_symlink():
+                        stack.append(dir_entry.path)
+                    continue
+                path = dir_entry.path.replace('\\', '/')
+                if path.startswith('./'):
+                    path = path[2:]
+                dir_entries[path] = dir_entry
+    stats_by_path = read_index_stats()
+    try:
+        index_mtime = int(os.stat(os.path.join('.git', 'index')).st_mtime)
+    except FileNotFoundError:
+        index_mtime = 0
+
+    candidates = []
+    new = []
+    for path, dir_entry in dir_entries.items():
+        if path not in stats_by_path:
+            new.append(path)
+            continue
+        ctime_s, mtime_s, size, _ = stats_by_path[path]
+        st = dir_entry.stat()
+        # files modified in the same second the index was written are racy
+        # and have to be hashed even when their mtime and size match
+        if (st.st_size == size and int(st.st_mtime) == mtime_s and
+                int(st.st_ctime) == ctime_s and mtime_s < index_mtime):
+            continue
+        candidates.append(path)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        hashes = executor.map(hash_blob, candidates)
+        changed = [p for p, sha1 in hashes if sha1 != stats_by_path[p][3]]
+    deleted = [p for p in stats_by_path if p not in dir_entries]
 
     return (sorted(changed), sorted(new), sorted(deleted))
 
@@ -214,43 +358,44 @@ def status():
 def diff():
 
     changed, _, _ = get_status()
-    entries_by_path = {e.path: e for e in read_index()}
+    stats_by_path = read_index_stats()
     for i, path in enumerate(changed):
-        sha1 = entries_by_path[path].sha1.hex()
+        sha1 = stats_by_path[path][3]
         obj_type, data = read_object(sha1)
         assert obj_type == 'blob'
-        index_lines = data.decode().splitlines()
-        working_lines = read_file(path).decode().splitlines()
-        diff_lines = difflib.unified_diff(
+        index_lines = data.splitlines()
+        working_lines = read_file(path).splitlines()
+        diff_lines = difflib.diff_bytes(
+            difflib.unified_diff,
             index_lines, working_lines,
-            '{} (index)'.format(path),
-            '{} (working copy)'.format(path),
-            lineterm='')
+            '{} (index)'.format(path).encode(),
+            '{} (working copy)'.format(path).encode(),
+            lineterm=b'')
         for line in diff_lines:
-            print(line)
+            sys.stdout.buffer.write(line + b'\n')
         if i < len(changed) - 1:
-            print('-' * 70)
+            sys.stdout.buffer.write(b'-' * 70 + b'\n')
 
 
 def write_index(entries):
 
-    packed_entries = []
-    for entry in entries:
-        entry_head = struct.pack('!LLLLLLLLLL20sH',
-                                 entry.ctime_s, entry.ctime_n, entry.mtime_s,
-                                 entry.mtime_n, entry.dev, entry.ino,
-                                 entry.mode, entry.uid, entry.gid,
-                                 entry.size, entry.sha1, entry.flags)
-
-        path = entry.path.encode()
-        length = ((62 + len(path) + 8) // 8) * 8
-        packed_entry = entry_head + path + b'\x00' * (length - 62 - len(path))
-        packed_entries.append(packed_entry)
-
-    header = struct.pack('!4sLL', b'DIRC', 2, len(entries))
-    all_data = header + b''.join(packed_entries)
-    digest = hashlib.sha1(all_data).digest()
-    write_file(os.path.join('.git', 'index'), all_data + digest)
+    paths = [entry.path.encode() for entry in entries]
+    lengths = [(62 + len(p) + 8) & ~7 for p in paths]
+    buf = bytearray(_HDR.size + sum(lengths))
+    _HDR.pack_into(buf, 0, b'DIRC', 2, len(entries))
+    pos = _HDR.size
+    for entry, path, length in zip(entries, paths, lengths):
+        _ENTRY.pack_into(buf, pos,
+                         entry.ctime_s, entry.ctime_n, entry.mtime_s,
+                         entry.mtime_n, entry.dev, entry.ino,
+                         entry.mode, entry.uid, entry.gid,
+                         entry.size, entry.sha1, entry.flags)
+        buf[pos + 62:pos + 62 + len(path)] = path
+        pos += length
+
+    digest = _sha1(buf).digest()
+    buf += digest
+    write_file(os.path.join('.git', 'index'), buf)
 
 
 def add(paths):
@@ -277,15 +422,16 @@ def add(paths):
 
 
 def write_tree():
-    tree_entries = []
+    tree = bytearray()
     for entry in read_index():
         assert '/' not in entry.path, \
             'currently only supports a single, top-level directory'
-        mode_path = '{:o} {}'.format(entry.mode, entry.path).encode()
-        tree_entry = mode_path + b'\x00' + entry.sha1
-        tree_entries.append(tree_entry)
+        tree += b'%o ' % entry.mode
+        tree += entry.path.encode()
+        tree += b'\x00'
+        tree += entry.sha1
 
-    return hash_object(b''.join(tree_entries), 'tree')
+    return hash_object(tree, 'tree')
 
 
 def get_local_main_hash():
@@ -310,15 +456,21 @@ def commit(message, author=None):
         '+' if utc_offset > 0 else '-',
         abs(utc_offset) // 3600,
         (abs(utc_offset) // 60) % 60)
-    lines = ['tree ' + tree]
+    signature = f"""{author} {author_time}\n""".encode()
+    data = bytearray(b'tree ')
+    data += tree.encode()
+    data += b'\n'
     if parent:
-        lines.append("parent " + parent)
-    lines.append(f"""author {author} {author_time}""")
-    lines.append(f"""committer {author} {author_time}""")
-    lines.append("")
-    lines.append(message)
-    lines.append("")
-    data = "\n".join(lines).encode()
+        data += b'parent '
+        data += parent.encode()
+        data += b'\n'
+    data += b'author '
+    data += signature
+    data += b'committer '
+    data += signature
+    data += b'\n'
+    data += message.encode()
+    data += b'\n'
     sha1 = hash_object(data, "commit")
     main_path = os.path.join(".git", "refs", "heads", "main")
     write_file(main_path, (sha1 + "\n").encode())
@@ -329,7 +481,7 @@ def commit(message, author=None):
 def extract_lines(data):
     lines = []
     i = 0
-    for _ in range(1000):
+    while i < len(data):
         line_length = int(data[i:i + 4], 16)
         line = data[i + 4:i + line_length]
         lines.append(line)
@@ -337,15 +489,13 @@ def extract_lines(data):
             i += 4
         else:
             i += line_length
-        if i >= len(data):
-            break
     return lines
 
 
 def build_lines_data(lines):
     result = []
     for line in lines:
-        result.append('{:04x}'.format(len(line) + 5).encode())
+        result.append(b'%04x' % (len(line) + 5))
         result.append(line)
         result.append(b'\n')
     result.append(b'0000')
@@ -377,76 +527,91 @@ def get_remote_main_hash(git_url, username, password):
 
 def read_tree(sha1=None, data=None):
     if sha1 is not None:
-        obj_type, data = read_object(sha1)
+        obj_type, data = read_object_cached(sha1)
         assert obj_type == 'tree'
     elif data is None:
         raise TypeError('must specify "sha1" or "data"')
     i = 0
     entries = []
-    for _ in range(1000):
-        end = data.find(b'\x00', i)
-        if end == -1:
-            break
-        mode_str, path = data[i:end].decode().split()
-        mode = int(mode_str, 8)
-        digest = data[end + 1:end + 21]
-        entries.append((mode, path, digest.hex()))
+    while i < len(data):
+        end = data.index(b'\x00', i)
+        space = data.index(b' ', i, end)
+        mode = int(data[i:space], 8)
+        path = data[space + 1:end].decode()
+        entries.append((mode, path, data[end + 1:end + 21].hex()))
         i = end + 1 + 20
     return entries
 
 
-def find_tree_objects(tree_sha1):
-    objects = {tree_sha1}
-    for mode, path, sha1 in read_tree(sha1=tree_sha1):
-        if stat.S_ISDIR(mode):
-            objects.update(find_tree_objects(sha1))
-        else:
-            objects.add(sha1)
+def find_tree_objects(tree_sha1, objects=None, known=frozenset()):
+    if objects is None:
+        objects = set()
+    stack = [tree_sha1]
+    while stack:
+        sha1 = stack.pop()
+        if sha1 in objects or sha1 in known:
+            continue
+        objects.add(sha1)
+        for mode, path, entry_sha1 in read_tree(sha1=sha1):
+            if stat.S_ISDIR(mode):
+                stack.append(entry_sha1)
+            elif entry_sha1 not in known:
+                objects.add(entry_sha1)
     return objects
 
 
-def find_commit_objects(commit_sha1):
-    objects = {commit_sha1}
-    obj_type, commit = read_object(commit_sha1)
-    assert obj_type == 'commit'
-    lines = commit.decode().splitlines()
-    tree = next(lr[5:45] for lr in lines if lr.startswith('tree '))
-    objects.update(find_tree_objects(tree))
-    parents = (lr[7:47] for lr in lines if lr.startswith('parent '))
-    for parent in parents:
-        objects.update(find_commit_objects(parent))
+def find_commit_objects(commit_sha1, known=frozenset()):
+    objects = set()
+    queue = collections.deque([commit_sha1])
+    while queue:
+        sha1 = queue.popleft()
+        if sha1 in objects or sha1 in known:
+            continue
+        objects.add(sha1)
+        obj_type, commit = read_object_cached(sha1)
+        assert obj_type == 'commit'
+        headers = commit.split(b'\n\n', 1)[0]
+        for kind, link_sha1 in _COMMIT_LINK.findall(headers):
+            if kind == b'tree':
+                find_tree_objects(link_sha1.decode(), objects, known)
+            else:
+                queue.append(link_sha1.decode())
     return objects
 
 
 def find_missing_objects(local_sha1, remote_sha1):
-    local_objects = find_commit_objects(local_sha1)
     if remote_sha1 is None:
-        return local_objects
+        return find_commit_objects(local_sha1)
     remote_objects = find_commit_objects(remote_sha1)
-    return local_objects - remote_objects
+    return find_commit_objects(local_sha1, known=remote_objects)
 
 
 def encode_pack_object(obj):
-    obj_type, data = read_object(obj)
+    obj_type, data = read_object_cached(obj, store=False)
     type_num = ObjectType[obj_type].value
     size = len(data)
     byte = (type_num << 4) | (size & 0x0f)
     size >>= 4
-    header = []
+    header = bytearray()
     while size:
         header.append(byte | 0x80)
         byte = size & 0x7f
         size >>= 7
     header.append(byte)
-    return bytes(header) + zlib.compress(data)
-
-
-def create_pack(objects):
-    header = struct.pack('!4sLL', b'PACK', 2, len(objects))
-    body = b''.join(encode_pack_object(o) for o in sorted(objects))
-    contents = header + body
-    sha1 = hashlib.sha1(contents).digest()
-    data = contents + sha1
+    return bytes(header) + zlib.compress(data, 6)
+
+
+def create_pack(objects, data=None):
+    if data is None:
+        data = bytearray()
+    header = _HDR.pack(b'PACK', 2, len(objects))
+    data += header
+    h = _sha1(header)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for encoded in executor.map(encode_pack_object, sorted(objects)):
+            h.update(encoded)
+            data += encoded
+    data += h.digest()
     return data
 
 
@@ -457,13 +622,16 @@ def push(git_url, username=None, password=None):
         password = os.environ['GIT_PASSWORD']
     remote_sha1 = get_remote_main_hash(git_url, username, password)
     local_sha1 = get_local_main_hash()
-    missing = find_missing_objects(local_sha1, remote_sha1)
-    print('updating remote main from {} to {} ({} object{})'.format(
-        remote_sha1 or 'no commits', local_sha1, len(missing),
-        '' if len(missing) == 1 else 's'))
-    lines = [
-        f"""{remote_sha1 or ('0' * 40)} {local_sha1} refs/heads/main\x00 report-status""".encode()]
-    data = build_lines_data(lines) + create_pack(missing)
+    try:
+        missing = find_missing_objects(local_sha1, remote_sha1)
+        print('updating remote main from {} to {} ({} object{})'.format(
+            remote_sha1 or 'no commits', local_sha1, len(missing),
+            '' if len(missing) == 1 else 's'))
+        lines = [
+            f"""{remote_sha1 or ('0' * 40)} {local_sha1} refs/heads/main\x00 report-status""".encode()]
+        data = create_pack(missing, bytearray(build_lines_data(lines)))
+    finally:
+        _object_cache.clear()
     url = git_url + '/git-receive-pack'
     response = http_request(url, username, password, data=data)
     lines = extract_lines(response)